@@ -11,10 +11,18 @@ Usage:
     python diesel_analysis.py --fleet              # Current fleet age distribution
     python diesel_analysis.py --trends             # Mileage trends over time
     python diesel_analysis.py --summary            # Quick diesel summary
+    python diesel_analysis.py --rebuild-cache      # Rebuild diesel-only cache
+    python diesel_analysis.py --all --fast         # Approximate distinct counts/medians
+
+The first run extracts diesel tests from the full MOT dataset into a
+Parquet cache (partitioned by registration year, with dates already
+parsed). All analyses read from that cache.
 """
 
 import argparse
+import shutil
 import sys
+from datetime import date, datetime
 from pathlib import Path
 
 # Add parent directory to path for lib imports
@@ -22,9 +30,99 @@ sys.path.insert(0, str(Path(__file__).parent.parent))
 
 from lib.db import get_connection, get_table_pattern
 
+# fuelType spellings seen in the MOT data. Matching the raw column with IN
+# (rather than UPPER(fuelType) = 'DIESEL') lets DuckDB prune Parquet row
+# groups using min/max statistics.
+DIESEL_FUEL_TYPES = "('DIESEL', 'Diesel', 'diesel')"
+
+# Diesel-only, pre-parsed copy of the MOT tests (see build_diesel_cache)
+DIESEL_CACHE_DIR = Path('/Volumes/T7/MOT/data/diesel_tests')
+# View over the diesel cache that the analyses query by default
+DIESEL_VIEW = 'diesel_tests'
+
+CURRENT_YEAR = datetime.now().year
+
+
+def build_diesel_cache(con, pattern: str, cache_dir: Path = DIESEL_CACHE_DIR):
+    """
+    Extract diesel tests from the full MOT dataset into a Parquet cache.
+
+    Dates are cast once here, and reg_year / test_year / vehicle_age are
+    stored as integers. The cache is partitioned by reg_year.
+    """
+    print(f"\nBuilding diesel cache in {cache_dir}...")
+
+    # Write to a sibling directory first so an interrupted build
+    # never leaves a half-written cache behind
+    tmp_dir = cache_dir.with_name(cache_dir.name + '.tmp')
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+
+    con.execute(f"""
+        COPY (
+            SELECT
+                registration,
+                test_date,
+                first_used_date,
+                YEAR(test_date) as test_year,
+                YEAR(first_used_date) as reg_year,
+                test_year - reg_year as vehicle_age,  -- reuses the aliases above
+                odometerValue,
+                odometerResultType
+            FROM (
+                SELECT
+                    registration,
+                    TRY_CAST(testDate AS DATE) as test_date,
+                    TRY_CAST(firstUsedDate AS DATE) as first_used_date,
+                    odometerValue,
+                    odometerResultType
+                FROM read_parquet('{pattern}')
+                WHERE fuelType IN {DIESEL_FUEL_TYPES}
+            )
+            -- Sorted so each row group covers a narrow test_date range,
+            -- which makes its min/max statistics useful for pruning
+            ORDER BY test_date
+        ) TO '{tmp_dir}' (FORMAT PARQUET, PARTITION_BY (reg_year))
+    """)
+
+    if cache_dir.exists():
+        shutil.rmtree(cache_dir)
+    tmp_dir.rename(cache_dir)
+
+
+def get_diesel_cache(con, pattern: str, rebuild: bool = False,
+                     cache_dir: Path = DIESEL_CACHE_DIR) -> str:
+    """Return the glob for the diesel cache, building it if needed."""
+    if rebuild or not any(cache_dir.glob('**/*.parquet')):
+        build_diesel_cache(con, pattern, cache_dir)
+    return str(cache_dir / '**' / '*.parquet')
+
+
+def register_diesel_view(con, pattern: str, view_name: str = DIESEL_VIEW):
+    """Expose the diesel cache files as a view so every query shares one definition."""
+    con.execute(f"""
+        CREATE OR REPLACE VIEW {view_name} AS
+        SELECT * FROM read_parquet('{pattern}', hive_partitioning=true)
+    """)
+
+
+def count_distinct_sql(expr: str, approximate: bool = False) -> str:
+    """SQL distinct count, or a HyperLogLog estimate if approximate is requested."""
+    return f"APPROX_COUNT_DISTINCT({expr})" if approximate else f"COUNT(DISTINCT {expr})"
+
+
+def median_sql(expr: str, approximate: bool = False) -> str:
+    """SQL median, or an approximate quantile if approximate is requested."""
+    return f"APPROX_QUANTILE({expr}, 0.5)" if approximate else f"MEDIAN({expr})"
+
+
+def diesel_summary(con, table_name: str = DIESEL_VIEW, approximate: bool = False):
+    """
+    Quick summary of diesel vehicles in the dataset.
 
-def diesel_summary(con, pattern: str):
-    """Quick summary of diesel vehicles in the dataset."""
+    With approximate=True the vehicle total and median mileage are
+    estimates (labelled in the output); the per-year ranking stays exact.
+    """
     print("\nDiesel Vehicle Summary")
     print("=" * 60)
 
@@ -32,15 +130,15 @@ def diesel_summary(con, pattern: str):
     result = con.execute(f"""
         SELECT
             COUNT(*) as total_tests,
-            COUNT(DISTINCT registration) as unique_vehicles,
-            MIN(CASE WHEN YEAR(TRY_CAST(testDate AS DATE)) >= 2005 THEN testDate END) as earliest_test,
-            MAX(testDate) as latest_test
-        FROM read_parquet('{pattern}')
-        WHERE UPPER(fuelType) = 'DIESEL'
+            {count_distinct_sql('registration', approximate)} as unique_vehicles,
+            MIN(CASE WHEN test_year >= 2005 THEN test_date END) as earliest_test,
+            MAX(test_date) as latest_test
+        FROM {table_name}
     """).fetchone()
 
     print(f"Total diesel tests:     {result[0]:,}")
-    print(f"Unique diesel vehicles: {result[1]:,}")
+    approx_label = " (approx.)" if approximate else ""
+    print(f"Unique diesel vehicles: {result[1]:,}{approx_label}")
     print(f"Date range:             {str(result[2])[:10]} to {str(result[3])[:10]}")
 
     # Odometer coverage
@@ -49,9 +147,8 @@ def diesel_summary(con, pattern: str):
             COUNT(*) as total,
             SUM(CASE WHEN odometerResultType = 'READ' THEN 1 ELSE 0 END) as valid_odometer,
             AVG(CASE WHEN odometerResultType = 'READ' THEN odometerValue END) as avg_mileage,
-            MEDIAN(CASE WHEN odometerResultType = 'READ' THEN odometerValue END) as median_mileage
-        FROM read_parquet('{pattern}')
-        WHERE UPPER(fuelType) = 'DIESEL'
+            {median_sql("CASE WHEN odometerResultType = 'READ' THEN odometerValue END", approximate)} as median_mileage
+        FROM {table_name}
     """).fetchone()
 
     pct_valid = 100.0 * result[1] / result[0] if result[0] > 0 else 0
@@ -59,19 +156,17 @@ def diesel_summary(con, pattern: str):
     median_mileage = result[3] if result[3] else 0
     print(f"\nOdometer coverage:      {pct_valid:.1f}%")
     print(f"Average mileage:        {avg_mileage:,.0f} miles")
-    print(f"Median mileage:         {median_mileage:,.0f} miles")
+    print(f"Median mileage:         {median_mileage:,.0f} miles{approx_label}")
 
     # Registration year distribution (sample)
     print("\nVehicles by registration year (top 10):")
     results = con.execute(f"""
         SELECT
-            YEAR(TRY_CAST(firstUsedDate AS DATE)) as reg_year,
+            reg_year,
             COUNT(DISTINCT registration) as vehicles
-        FROM read_parquet('{pattern}')
-        WHERE UPPER(fuelType) = 'DIESEL'
-          AND firstUsedDate IS NOT NULL
+        FROM {table_name}
+        WHERE reg_year BETWEEN 2005 AND 2025
         GROUP BY reg_year
-        HAVING reg_year >= 2005 AND reg_year <= 2025
         ORDER BY vehicles DESC
         LIMIT 10
     """).fetchall()
@@ -80,15 +175,13 @@ def diesel_summary(con, pattern: str):
         print(f"  {row[0]}: {row[1]:,} vehicles")
 
 
-def survival_curve(con, pattern: str, min_year: int = 2005, max_year: int = 2020):
+def survival_curve(con, min_year: int = 2005, max_year: int = 2020, table_name: str = DIESEL_VIEW):
     """
     Calculate survival rates for diesel vehicles by registration year.
 
     Survival = vehicles with MOT in recent period / vehicles ever registered
     """
-    # Get current year dynamically
-    from datetime import datetime
-    current_year = datetime.now().year
+    current_year = CURRENT_YEAR
     recent_year = current_year - 1  # Look for tests in last 2 years
 
     print("\nDiesel Vehicle Survival Rates")
@@ -99,36 +192,37 @@ def survival_curve(con, pattern: str, min_year: int = 2005, max_year: int = 2020
     # For each registration year, count:
     # 1. Vehicles with any MOT test (with valid odometer)
     # 2. Vehicles with recent MOT (same filter applied consistently)
-    # FIX: Apply same odometerResultType filter to both CTEs to avoid survivorship bias
+    # FIX: Apply same odometerResultType filter to both counts to avoid survivorship bias
+    # Both come from one pass: collapse tests to one row per vehicle holding
+    # its last test date, then count per registration year.
+    # Values are bound as parameters so the query text stays constant.
     query = f"""
-        WITH diesel_vehicles AS (
-            SELECT DISTINCT
+        WITH per_vehicle AS (
+            SELECT
                 registration,
-                YEAR(TRY_CAST(firstUsedDate AS DATE)) as reg_year
-            FROM read_parquet('{pattern}')
-            WHERE UPPER(fuelType) = 'DIESEL'
-              AND odometerResultType = 'READ'
-        ),
-        recent_tests AS (
-            SELECT DISTINCT registration
-            FROM read_parquet('{pattern}')
-            WHERE UPPER(fuelType) = 'DIESEL'
+                MIN(reg_year) as reg_year,
+                MAX(test_date) as last_test_date
+            FROM {table_name}
+            WHERE reg_year BETWEEN $min_year AND $max_year
               AND odometerResultType = 'READ'
-              AND YEAR(TRY_CAST(testDate AS DATE)) >= {recent_year}
+            GROUP BY registration
         )
         SELECT
-            d.reg_year,
-            COUNT(DISTINCT d.registration) as total_registered,
-            COUNT(DISTINCT r.registration) as still_active,
-            {current_year} - d.reg_year as vehicle_age
-        FROM diesel_vehicles d
-        LEFT JOIN recent_tests r ON d.registration = r.registration
-        WHERE d.reg_year >= {min_year} AND d.reg_year <= {max_year}
-        GROUP BY d.reg_year
-        ORDER BY d.reg_year
+            reg_year,
+            COUNT(*) as total_registered,
+            COUNT(*) FILTER (WHERE last_test_date >= $recent_start) as still_active,
+            $current_year - reg_year as vehicle_age
+        FROM per_vehicle
+        GROUP BY reg_year
+        ORDER BY reg_year
     """
 
-    results = con.execute(query).fetchall()
+    results = con.execute(query, {
+        'min_year': min_year,
+        'max_year': max_year,
+        'recent_start': date(recent_year, 1, 1),
+        'current_year': current_year,
+    }).fetchall()
 
     print(f"{'Reg Year':<10} {'Age':>5} {'Registered':>12} {'Active':>14} {'Survival %':>12}")
     print("-" * 70)
@@ -142,52 +236,64 @@ def survival_curve(con, pattern: str, min_year: int = 2005, max_year: int = 2020
     print(f"\nNote: 'Active' means passed an MOT in {recent_year}-{current_year}")
 
 
-def annual_mileage_by_age(con, pattern: str, sample_pct: float = 10):
+def annual_mileage_by_age(con, sample_pct: float = 10, table_name: str = DIESEL_VIEW,
+                          approximate: bool = False):
     """
     Calculate average annual mileage by vehicle age.
 
-    Uses delta between consecutive MOT readings.
+    Uses delta between consecutive MOT readings. With approximate=True
+    the median is an estimate.
     """
     print("\nAnnual Mileage by Vehicle Age (Diesel)")
     print("=" * 60)
     print(f"(Based on {sample_pct}% sample of consecutive MOT readings)")
     print()
 
-    # This query calculates mileage delta between consecutive tests
-    # and groups by vehicle age at time of test
+    # For each sampled reading, find the latest earlier reading ~1 year
+    # before it (a per-registration lookup rather than a window over the
+    # whole table), then group the mileage delta by vehicle age
     query = f"""
-        WITH ordered_tests AS (
+        WITH readings AS (
             SELECT
                 registration,
-                testDate,
+                test_date,
                 odometerValue,
-                YEAR(TRY_CAST(testDate AS DATE)) - YEAR(TRY_CAST(firstUsedDate AS DATE)) as vehicle_age,
-                LAG(odometerValue) OVER (PARTITION BY registration ORDER BY testDate) as prev_mileage,
-                LAG(testDate) OVER (PARTITION BY registration ORDER BY testDate) as prev_test_date
-            FROM read_parquet('{pattern}')
-            WHERE UPPER(fuelType) = 'DIESEL'
+                vehicle_age
+            FROM {table_name}
+            WHERE odometerValue > 0
               AND odometerResultType = 'READ'
-              AND odometerValue > 0
+        ),
+        sampled AS (
+            SELECT *
+            FROM readings
+            WHERE vehicle_age >= 3 AND vehicle_age <= 20
             USING SAMPLE {sample_pct} PERCENT (bernoulli)
         ),
         mileage_deltas AS (
             SELECT
-                vehicle_age,
-                odometerValue - prev_mileage as mileage_delta,
-                DATEDIFF('day', TRY_CAST(prev_test_date AS DATE), TRY_CAST(testDate AS DATE)) as days_between
-            FROM ordered_tests
-            WHERE prev_mileage IS NOT NULL
-              AND odometerValue > prev_mileage
-              AND vehicle_age >= 3 AND vehicle_age <= 20
+                s.vehicle_age,
+                s.odometerValue - p.prev_mileage as mileage_delta,
+                DATEDIFF('day', p.prev_test_date, s.test_date) as days_between
+            FROM sampled s,
+            LATERAL (
+                SELECT
+                    MAX(r.test_date) as prev_test_date,
+                    ARG_MAX(r.odometerValue, r.test_date) as prev_mileage
+                FROM readings r
+                WHERE r.registration = s.registration
+                  AND r.test_date < s.test_date
+                  AND s.test_date - r.test_date BETWEEN 300 AND 450  -- ~1 year between tests
+            ) p
+            WHERE p.prev_test_date IS NOT NULL
+              AND s.odometerValue > p.prev_mileage
         )
         SELECT
             vehicle_age,
             COUNT(*) as samples,
             ROUND(AVG(mileage_delta * 365.0 / NULLIF(days_between, 0)), 0) as avg_annual_miles,
-            ROUND(MEDIAN(mileage_delta * 365.0 / NULLIF(days_between, 0)), 0) as median_annual_miles
+            ROUND({median_sql('mileage_delta * 365.0 / NULLIF(days_between, 0)', approximate)}, 0) as median_annual_miles
         FROM mileage_deltas
-        WHERE days_between >= 300 AND days_between <= 450  -- ~1 year between tests
-          AND mileage_delta > 0 AND mileage_delta < 50000  -- Reasonable range
+        WHERE mileage_delta > 0 AND mileage_delta < 50000  -- Reasonable range
         GROUP BY vehicle_age
         ORDER BY vehicle_age
     """
@@ -204,16 +310,17 @@ def annual_mileage_by_age(con, pattern: str, sample_pct: float = 10):
 
     print("-" * 50)
     print("\nNote: Based on ~1 year gaps between consecutive MOT tests")
+    if approximate:
+        print("      Median annual mileage is approximate (--fast)")
 
 
-def fleet_age_distribution(con, pattern: str):
+def fleet_age_distribution(con, table_name: str = DIESEL_VIEW):
     """
     Count active diesel vehicles by registration year.
 
     'Active' means passed MOT in recent period.
     """
-    from datetime import datetime
-    current_year = datetime.now().year
+    current_year = CURRENT_YEAR
     recent_year = current_year - 1
 
     print("\nActive Diesel Fleet Age Distribution")
@@ -223,19 +330,21 @@ def fleet_age_distribution(con, pattern: str):
 
     query = f"""
         SELECT
-            YEAR(TRY_CAST(firstUsedDate AS DATE)) as reg_year,
+            reg_year,
             COUNT(DISTINCT registration) as active_vehicles,
-            {current_year} - YEAR(TRY_CAST(firstUsedDate AS DATE)) as age
-        FROM read_parquet('{pattern}')
-        WHERE UPPER(fuelType) = 'DIESEL'
-          AND YEAR(TRY_CAST(testDate AS DATE)) >= {recent_year}
-          AND firstUsedDate IS NOT NULL
+            $current_year - reg_year as age
+        FROM {table_name}
+        WHERE reg_year BETWEEN 2000 AND $max_reg_year
+          AND test_date >= $recent_start
         GROUP BY reg_year
-        HAVING reg_year >= 2000 AND reg_year <= {current_year - 3}
         ORDER BY reg_year DESC
     """
 
-    results = con.execute(query).fetchall()
+    results = con.execute(query, {
+        'current_year': current_year,
+        'max_reg_year': current_year - 3,
+        'recent_start': date(recent_year, 1, 1),
+    }).fetchall()
 
     total = sum(r[1] for r in results)
 
@@ -251,7 +360,7 @@ def fleet_age_distribution(con, pattern: str):
     print(f"{'Total':<10} {'':>5} {total:>16,}")
 
 
-def mileage_trend_over_time(con, pattern: str):
+def mileage_trend_over_time(con, table_name: str = DIESEL_VIEW):
     """
     Track how diesel mileage has changed over different test years.
 
@@ -265,18 +374,17 @@ def mileage_trend_over_time(con, pattern: str):
     # Compare mileage for 5-year-old diesels across different test years
     query = f"""
         SELECT
-            YEAR(TRY_CAST(testDate AS DATE)) as test_year,
-            YEAR(TRY_CAST(testDate AS DATE)) - YEAR(TRY_CAST(firstUsedDate AS DATE)) as vehicle_age,
+            test_year,
+            vehicle_age,
             COUNT(*) as tests,
             ROUND(AVG(odometerValue), 0) as avg_mileage,
             ROUND(MEDIAN(odometerValue), 0) as median_mileage
-        FROM read_parquet('{pattern}')
-        WHERE UPPER(fuelType) = 'DIESEL'
+        FROM {table_name}
+        WHERE odometerValue BETWEEN 1 AND 499999
+          AND test_date >= DATE '2015-01-01' AND test_date < DATE '2025-01-01'
+          AND vehicle_age IN (5, 10, 15)
           AND odometerResultType = 'READ'
-          AND odometerValue > 0 AND odometerValue < 500000
         GROUP BY test_year, vehicle_age
-        HAVING vehicle_age IN (5, 10, 15)
-           AND test_year >= 2015 AND test_year <= 2024
         ORDER BY vehicle_age, test_year
     """
 
@@ -311,6 +419,9 @@ def main():
     parser.add_argument('--trends', action='store_true', help='Show mileage trends over time')
     parser.add_argument('--summary', action='store_true', help='Quick diesel summary')
     parser.add_argument('--all', action='store_true', help='Run all analyses')
+    parser.add_argument('--rebuild-cache', action='store_true', help='Rebuild the diesel-only Parquet cache')
+    parser.add_argument('--fast', action='store_true',
+                        help='Approximate distinct counts and medians in the summary and mileage analyses')
 
     args = parser.parse_args()
 
@@ -319,25 +430,30 @@ def main():
         args.summary = True
 
     con = get_connection()
-    pattern = get_table_pattern('tests')
+    # Keep Parquet footers (row-group statistics) in memory across queries
+    con.execute("SET parquet_metadata_cache = true")
+    mot_pattern = get_table_pattern('tests')
 
     print("Diesel Vehicle Analysis")
-    print("Using:", pattern)
+    print("Using:", mot_pattern)
+
+    pattern = get_diesel_cache(con, mot_pattern, rebuild=args.rebuild_cache)
+    register_diesel_view(con, pattern)
 
     if args.summary or args.all:
-        diesel_summary(con, pattern)
+        diesel_summary(con, approximate=args.fast)
 
     if args.survival or args.all:
-        survival_curve(con, pattern)
+        survival_curve(con)
 
     if args.mileage or args.all:
-        annual_mileage_by_age(con, pattern)
+        annual_mileage_by_age(con, approximate=args.fast)
 
     if args.fleet or args.all:
-        fleet_age_distribution(con, pattern)
+        fleet_age_distribution(con)
 
     if args.trends or args.all:
-        mileage_trend_over_time(con, pattern)
+        mileage_trend_over_time(con)
 
     print("\nAnalysis complete.")
 
@@ -22,6 +22,11 @@ from pathlib import Path
 import pandas as pd
 import numpy as np
 
+try:
+    from numba import njit
+except ImportError:  # numba is optional; fall back to plain NumPy
+    njit = None
+
 # Add parent directory to path for lib imports
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
@@ -140,37 +145,107 @@ DIESEL_MPG_BY_AGE = {
 }
 
 
-def load_external_data():
-    """Load external CSV data files."""
-    data = {}
+# ============================================================================
+# PER-AGE LOOKUP ARRAYS
+# ============================================================================
 
-    # Car sales
-    try:
-        df = pd.read_csv(DATA_DIR / 'car_sales.csv', comment='#')
-        data['car_sales'] = df.set_index('year')
-    except Exception as e:
-        print(f"Warning: Could not load car_sales.csv: {e}")
+# The fleet model tracks vehicles up to this age
+MAX_AGE = 25
+# Earliest registration year included in the fleet
+FIRST_COHORT_YEAR = 1995
+
+# Dense arrays indexed by vehicle age, for vectorised fleet calculations
+AGES = np.arange(MAX_AGE + 1)
+SURVIVAL_BY_AGE = np.array([SURVIVAL_RATES.get(age, 0) for age in AGES])
+MILEAGE_BY_AGE = np.array([ANNUAL_MILEAGE_BY_AGE.get(age, 4000) for age in AGES])
+MPG_BY_AGE = np.array([DIESEL_MPG_BY_AGE.get(age, 40) for age in AGES])
+
+
+# External datasets: columns the model needs, and columns only shown in
+# the summary (filled with NaN when a file doesn't have them)
+EXTERNAL_COLUMNS = {
+    'car_sales': (['diesel_new_cars'], ['diesel_share']),
+    'fleet_size': ([], ['diesel_cars_millions']),
+    'fuel_consumption': (['diesel_billion_litres'], []),
+    'van_sales': (['diesel_lcv'], ['diesel_share']),
+}
 
-    # Fleet size
-    try:
-        df = pd.read_csv(DATA_DIR / 'fleet_size.csv', comment='#')
-        data['fleet_size'] = df.set_index('year')
-    except Exception as e:
-        print(f"Warning: Could not load fleet_size.csv: {e}")
 
-    # Fuel consumption
+def _cache_external(df: pd.DataFrame, path: Path):
+    """Save a parsed CSV as Parquet so later runs can skip parsing it."""
     try:
-        df = pd.read_csv(DATA_DIR / 'fuel_consumption.csv', comment='#')
-        data['fuel_consumption'] = df.set_index('year')
-    except Exception as e:
-        print(f"Warning: Could not load fuel_consumption.csv: {e}")
+        df.to_parquet(path, index=False)
+    except ImportError:
+        pass  # No Parquet engine (pyarrow) installed; keep reading the CSV
+    except OSError as e:
+        print(f"Warning: Could not write {path.name}: {e}")
+
+
+def _read_external(name: str) -> pd.DataFrame:
+    """Read one external dataset, preferring its Parquet cache over the CSV."""
+    required, optional = EXTERNAL_COLUMNS[name]
+    csv_path = DATA_DIR / f'{name}.csv'
+    parquet_path = DATA_DIR / f'{name}.parquet'
+
+    # Reparse the CSV if it has been edited since the cache was written
+    if parquet_path.exists() and (
+        not csv_path.exists() or parquet_path.stat().st_mtime >= csv_path.stat().st_mtime
+    ):
+        try:
+            df = pd.read_parquet(parquet_path, columns=['year'] + required + optional)
+            return df.set_index('year')
+        except Exception:
+            pass  # No Parquet engine, or an unreadable/outdated cache; reparse the CSV
+
+    df = pd.read_csv(csv_path, comment='#')
+    missing = [column for column in required if column not in df.columns]
+    if missing:
+        raise KeyError(f"{csv_path.name} is missing required columns: {missing}")
+    # Display-only columns the file doesn't have are added as NaN
+    df = df.reindex(columns=['year'] + required + optional)
+    _cache_external(df, parquet_path)
+    return df.set_index('year')
+
+
+def _to_dense(df: pd.DataFrame) -> dict:
+    """
+    Convert a year-indexed DataFrame to dense per-year arrays.
+
+    Returns a dict with 'min_year', 'max_year' and one float array per
+    column, where array[year - min_year] is that year's value (NaN for
+    years missing from the data).
+    """
+    years = df.index.to_numpy()
+    min_year, max_year = int(years.min()), int(years.max())
+    dense = {'min_year': min_year, 'max_year': max_year}
+    for column in df.columns:
+        values = np.full(max_year - min_year + 1, np.nan)
+        values[years - min_year] = df[column].to_numpy(dtype=float)
+        dense[column] = values
+    return dense
 
-    # Van sales
-    try:
-        df = pd.read_csv(DATA_DIR / 'van_sales.csv', comment='#')
-        data['van_sales'] = df.set_index('year')
-    except Exception as e:
-        print(f"Warning: Could not load van_sales.csv: {e}")
+
+def _lookup(dataset: dict, column: str, years) -> np.ndarray:
+    """Values of a dense column for the given years, NaN outside the data."""
+    values = dataset[column]
+    idx = np.asarray(years) - dataset['min_year']
+    inside = (idx >= 0) & (idx < len(values))
+    return np.where(inside, values[np.clip(idx, 0, len(values) - 1)], np.nan)
+
+
+def load_external_data():
+    """
+    Load external data files (car sales, fleet size, fuel consumption, van sales).
+
+    Each dataset is returned as dense per-year arrays (see _to_dense).
+    """
+    data = {}
+
+    for name in EXTERNAL_COLUMNS:
+        try:
+            data[name] = _to_dense(_read_external(name))
+        except Exception as e:
+            print(f"Warning: Could not load {name}.csv: {e}")
 
     return data
 
@@ -179,7 +254,11 @@ def build_fleet_model(data: dict, base_year: int = 2010, forecast_year: int = 20
     """
     Build a fleet model from historical sales and survival curves.
 
-    For each year, tracks vehicles by registration year cohort.
+    For each year, tracks vehicles by age (i.e. by registration year cohort).
+
+    Returns:
+        (years, fleet) where fleet[i, age] is the number of vehicles of
+        that age on the road in years[i]
     """
     print(f"\nBuilding fleet model from {base_year} to {forecast_year}...")
 
@@ -187,89 +266,76 @@ def build_fleet_model(data: dict, base_year: int = 2010, forecast_year: int = 20
     if car_sales is None:
         raise ValueError("Car sales data required")
 
-    # Initialize fleet structure: {year: {reg_year: vehicle_count}}
-    fleet = {}
-
-    for year in range(base_year, forecast_year + 1):
-        fleet[year] = {}
-
-        # For each cohort (vehicles registered in each year)
-        for reg_year in range(1995, year + 1):
-            age = year - reg_year
-
-            # Skip very old vehicles or those not yet registered
-            # FIX: Include ages 0-2 (new vehicles also consume fuel)
-            if age < 0 or age > 25:
-                continue
-
-            # Get new registrations for this cohort
-            if reg_year in car_sales.index:
-                new_cars = car_sales.loc[reg_year, 'diesel_new_cars']
-            else:
-                # Extrapolate based on trend
-                if reg_year > car_sales.index.max():
-                    # Future: declining trend
-                    last_year = car_sales.index.max()
-                    decline_rate = 0.85  # 15% decline per year
-                    years_ahead = reg_year - last_year
-                    new_cars = car_sales.loc[last_year, 'diesel_new_cars'] * (decline_rate ** years_ahead)
-                else:
-                    continue
-
-            # Apply survival rate
-            survival = SURVIVAL_RATES.get(age, 0)
-            surviving = int(new_cars * survival)
-
-            if surviving > 0:
-                fleet[year][reg_year] = surviving
-
-    return fleet
-
-
-def calculate_consumption(fleet: dict, mileage_adjustment: float = 1.0):
+    years = np.arange(base_year, forecast_year + 1)
+    reg_years = np.arange(FIRST_COHORT_YEAR, forecast_year + 1)
+
+    # New registrations for each cohort; years with no sales data
+    # contribute no vehicles
+    new_cars = _lookup(car_sales, 'diesel_new_cars', reg_years)
+
+    # Extrapolate future cohorts: declining trend
+    last_year = car_sales['max_year']
+    decline_rate = 0.85  # 15% decline per year
+    future = reg_years > last_year
+    new_cars[future] = car_sales['diesel_new_cars'][-1] * decline_rate ** (reg_years[future] - last_year)
+    new_cars = np.nan_to_num(new_cars)
+
+    # Cohort index for every (year, age) cell
+    # FIX: Include ages 0-2 (new vehicles also consume fuel)
+    cohort = years[:, None] - AGES[None, :] - FIRST_COHORT_YEAR
+    registered = cohort >= 0
+
+    # Apply survival rate
+    fleet = new_cars[np.where(registered, cohort, 0)] * SURVIVAL_BY_AGE
+    return years, np.floor(np.where(registered, fleet, 0))
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _consume(fleet, mileage, mpg):
+        """Per-year vehicle, mile and litre totals in a single pass over the fleet."""
+        n_years, n_ages = fleet.shape
+        vehicles = np.zeros(n_years)
+        miles = np.zeros(n_years)
+        litres = np.zeros(n_years)
+        for i in range(n_years):
+            for age in range(n_ages):
+                count = fleet[i, age]
+                age_miles = count * mileage[age]
+                vehicles[i] += count
+                miles[i] += age_miles
+                # Litres = miles / mpg * 4.546 (UK gallon in litres)
+                litres[i] += age_miles / mpg[age] * 4.546
+        return vehicles, miles, litres
+else:
+    def _consume(fleet, mileage, mpg):
+        """Per-year vehicle, mile and litre totals (NumPy fallback)."""
+        miles = fleet * mileage
+        # Litres = miles / mpg * 4.546 (UK gallon in litres)
+        litres = miles / mpg * 4.546
+        return fleet.sum(axis=1), miles.sum(axis=1), litres.sum(axis=1)
+
+
+def calculate_consumption(years: np.ndarray, fleet: np.ndarray, mileage_adjustment: float = 1.0):
     """
     Calculate annual diesel consumption from fleet model.
 
     Args:
-        fleet: {year: {reg_year: vehicle_count}}
+        years: Years covered by the fleet model
+        fleet: Vehicle counts indexed by [year, age] (see build_fleet_model)
         mileage_adjustment: Factor to adjust mileage (e.g., 0.9 for -10%)
 
     Returns:
-        DataFrame with year, fleet_size, total_miles, litres_consumed
+        DataFrame indexed by year with fleet_size, total_miles, litres_consumed
     """
-    results = []
-
-    for year, cohorts in sorted(fleet.items()):
-        total_vehicles = 0
-        total_miles = 0
-        total_litres = 0
-
-        for reg_year, count in cohorts.items():
-            age = year - reg_year
-
-            # Get annual mileage for this age
-            annual_miles = ANNUAL_MILEAGE_BY_AGE.get(age, 4000) * mileage_adjustment
-
-            # Get fuel economy
-            mpg = DIESEL_MPG_BY_AGE.get(age, 40)
+    vehicles, miles, litres = _consume(fleet, MILEAGE_BY_AGE * mileage_adjustment, MPG_BY_AGE)
 
-            # Calculate
-            miles = count * annual_miles
-            # Litres = miles / mpg * 4.546 (UK gallon in litres)
-            litres = miles / mpg * 4.546
-
-            total_vehicles += count
-            total_miles += miles
-            total_litres += litres
-
-        results.append({
-            'year': year,
-            'fleet_size_millions': total_vehicles / 1_000_000,
-            'total_miles_billions': total_miles / 1_000_000_000,
-            'car_litres_billions': total_litres / 1_000_000_000,
-        })
-
-    return pd.DataFrame(results)
+    return pd.DataFrame({
+        'year': years,
+        'fleet_size_millions': vehicles / 1_000_000,
+        'total_miles_billions': miles / 1_000_000_000,
+        'car_litres_billions': litres / 1_000_000_000,
+    }).set_index('year')
 
 
 def estimate_van_consumption(data: dict, years: list):
@@ -284,29 +350,31 @@ def estimate_van_consumption(data: dict, years: list):
         # Rough estimate: vans are ~40% of car consumption
         return None
 
-    results = []
     # Assume van fleet is ~4M and growing slowly
-    van_fleet = 4_000_000
+    initial_fleet = 4_000_000
     van_annual_miles = 12000
     van_mpg = 35
 
-    for year in years:
-        # Van fleet growth/decline based on sales
-        if year in van_sales.index:
-            diesel_vans_sold = van_sales.loc[year, 'diesel_lcv']
-            # Rough survival: assume 8% scrapped per year
-            van_fleet = van_fleet * 0.92 + diesel_vans_sold
+    # Van fleet growth/decline based on sales. In years with sales data,
+    # fleet = fleet * 0.92 + sold (rough survival: assume 8% scrapped per
+    # year); in other years the fleet is unchanged. This is solved for
+    # every year at once: dividing by the cumulative decay turns the
+    # recurrence into a running sum of sales.
+    diesel_vans_sold = _lookup(van_sales, 'diesel_lcv', years)
+    decay = np.where(np.isnan(diesel_vans_sold), 1.0, 0.92)
+    cumulative_decay = np.cumprod(decay)
+    van_fleet = cumulative_decay * (
+        initial_fleet + np.cumsum(np.nan_to_num(diesel_vans_sold) / cumulative_decay)
+    )
 
-        miles = van_fleet * van_annual_miles
-        litres = miles / van_mpg * 4.546
+    miles = van_fleet * van_annual_miles
+    litres = miles / van_mpg * 4.546
 
-        results.append({
-            'year': year,
-            'van_fleet_millions': van_fleet / 1_000_000,
-            'van_litres_billions': litres / 1_000_000_000,
-        })
-
-    return pd.DataFrame(results)
+    return pd.DataFrame({
+        'year': years,
+        'van_fleet_millions': van_fleet / 1_000_000,
+        'van_litres_billions': litres / 1_000_000_000,
+    }).set_index('year')
 
 
 def backtest(data: dict, start_year: int = 2015, end_year: int = 2024):
@@ -316,42 +384,40 @@ def backtest(data: dict, start_year: int = 2015, end_year: int = 2024):
     print("=" * 70)
 
     # Build fleet and calculate consumption
-    fleet = build_fleet_model(data, base_year=start_year, forecast_year=end_year)
-    car_consumption = calculate_consumption(fleet)
+    years, fleet = build_fleet_model(data, base_year=start_year, forecast_year=end_year)
+    car_consumption = calculate_consumption(years, fleet)
     van_consumption = estimate_van_consumption(data, list(range(start_year, end_year + 1)))
 
-    # Get actual consumption
+    # Get actual consumption for each year (NaN where not available)
     actual = data.get('fuel_consumption')
+    if actual is not None:
+        actual_litres = _lookup(actual, 'diesel_billion_litres', years)
+    else:
+        actual_litres = np.full(len(years), np.nan)
 
-    print(f"\n{'Year':<6} {'Car Litres':>12} {'Van Litres':>12} {'Total Pred':>12} {'Actual':>12} {'Error':>10}")
-    print("-" * 70)
-
-    for _, row in car_consumption.iterrows():
-        year = int(row['year'])
-        car_l = row['car_litres_billions']
-
-        van_l = 0
-        if van_consumption is not None:
-            van_row = van_consumption[van_consumption['year'] == year]
-            if len(van_row) > 0:
-                van_l = van_row.iloc[0]['van_litres_billions']
+    # Whole columns of predictions and errors, then one print per year
+    car_litres = car_consumption['car_litres_billions'].to_numpy()
+    van_litres = np.zeros(len(years))
+    if van_consumption is not None:
+        van_litres = van_consumption['van_litres_billions'].reindex(years, fill_value=0.0).to_numpy()
+    total_pred = car_litres + van_litres
 
-        total_pred = car_l + van_l
+    # Note: Total road diesel includes HGVs, buses - we're only predicting cars+vans
+    # Cars+vans are roughly 55-60% of total diesel consumption
+    # Estimate car+van share at ~55%; NaN where actual is not available
+    car_van_actual = actual_litres * 0.55
+    errors = ((total_pred - car_van_actual) / car_van_actual) * 100
 
-        # Note: Total road diesel includes HGVs, buses - we're only predicting cars+vans
-        # Cars+vans are roughly 55-60% of total diesel consumption
-        actual_val = None
-        error = None
-        if actual is not None and year in actual.index:
-            actual_val = actual.loc[year, 'diesel_billion_litres']
-            # Estimate car+van share at ~55%
-            car_van_actual = actual_val * 0.55
-            error = ((total_pred - car_van_actual) / car_van_actual) * 100
+    print(f"\n{'Year':<6} {'Car Litres':>12} {'Van Litres':>12} {'Total Pred':>12} {'Actual':>12} {'Error':>10}")
+    print("-" * 70)
 
-        actual_str = f"{actual_val:.1f}" if actual_val else "N/A"
-        error_str = f"{error:+.1f}%" if error else "N/A"
+    for year, car_l, van_l, pred, actual_val, error in zip(
+        years, car_litres, van_litres, total_pred, actual_litres, errors
+    ):
+        actual_str = f"{actual_val:.1f}" if not np.isnan(actual_val) else "N/A"
+        error_str = f"{error:+.1f}%" if not np.isnan(error) else "N/A"
 
-        print(f"{year:<6} {car_l:>12.2f} {van_l:>12.2f} {total_pred:>12.2f} {actual_str:>12} {error_str:>10}")
+        print(f"{year:<6} {car_l:>12.2f} {van_l:>12.2f} {pred:>12.2f} {actual_str:>12} {error_str:>10}")
 
     print("-" * 70)
     print("Note: Actual is total road diesel; cars+vans are ~55% of this")
@@ -363,18 +429,17 @@ def forecast(data: dict, target_year: int = 2035):
     print(f"FORECAST: Diesel car consumption to {target_year}")
     print("=" * 70)
 
-    fleet = build_fleet_model(data, base_year=2020, forecast_year=target_year)
-    consumption = calculate_consumption(fleet)
+    years, fleet = build_fleet_model(data, base_year=2020, forecast_year=target_year)
+    consumption = calculate_consumption(years, fleet)
 
     # Also model with declining mileage trend (diesels being driven less)
-    consumption_declining = calculate_consumption(fleet, mileage_adjustment=0.98)  # 2% less per year cumulative
+    consumption_declining = calculate_consumption(years, fleet, mileage_adjustment=0.98)  # 2% less per year cumulative
 
     print(f"\n{'Year':<6} {'Fleet (M)':>12} {'Miles (B)':>12} {'Litres (B)':>14} {'vs 2024':>10}")
     print("-" * 65)
 
     base_litres = None
-    for _, row in consumption.iterrows():
-        year = int(row['year'])
+    for year, row in consumption.iterrows():
         fleet_m = row['fleet_size_millions']
         miles_b = row['total_miles_billions']
         litres_b = row['car_litres_billions']
@@ -393,8 +458,8 @@ def forecast(data: dict, target_year: int = 2035):
 
     # Summary
     print("\nKey projections:")
-    row_2030 = consumption[consumption['year'] == 2030].iloc[0]
-    row_2035 = consumption[consumption['year'] == 2035].iloc[0] if target_year >= 2035 else None
+    row_2030 = consumption.loc[2030]
+    row_2035 = consumption.loc[2035] if target_year >= 2035 else None
 
     print(f"  2030: {row_2030['fleet_size_millions']:.1f}M vehicles, {row_2030['car_litres_billions']:.1f}B litres")
     if row_2035 is not None:
@@ -410,29 +475,29 @@ def summary(data: dict):
     print("\n1. CAR SALES DATA")
     if 'car_sales' in data:
         df = data['car_sales']
-        print(f"   Years: {df.index.min()} - {df.index.max()}")
-        latest = df.index.max()
-        print(f"   Latest ({latest}): {df.loc[latest, 'diesel_new_cars']:,.0f} diesel cars ({df.loc[latest, 'diesel_share']:.1f}% share)")
+        print(f"   Years: {df['min_year']} - {df['max_year']}")
+        latest = df['max_year']
+        print(f"   Latest ({latest}): {df['diesel_new_cars'][-1]:,.0f} diesel cars ({df['diesel_share'][-1]:.1f}% share)")
     else:
         print("   NOT AVAILABLE")
 
     print("\n2. FLEET SIZE DATA")
     if 'fleet_size' in data:
         df = data['fleet_size']
-        print(f"   Years: {df.index.min()} - {df.index.max()}")
-        latest = df.index.max()
-        print(f"   Latest ({latest}): {df.loc[latest, 'diesel_cars_millions']:.1f}M diesel cars")
+        print(f"   Years: {df['min_year']} - {df['max_year']}")
+        latest = df['max_year']
+        print(f"   Latest ({latest}): {df['diesel_cars_millions'][-1]:.1f}M diesel cars")
     else:
         print("   NOT AVAILABLE")
 
     print("\n3. FUEL CONSUMPTION DATA")
     if 'fuel_consumption' in data:
         df = data['fuel_consumption']
-        print(f"   Years: {df.index.min()} - {df.index.max()}")
-        latest = df.index.max()
-        print(f"   Latest ({latest}): {df.loc[latest, 'diesel_billion_litres']:.1f}B litres")
-        peak = df['diesel_billion_litres'].max()
-        peak_year = df['diesel_billion_litres'].idxmax()
+        print(f"   Years: {df['min_year']} - {df['max_year']}")
+        latest = df['max_year']
+        print(f"   Latest ({latest}): {df['diesel_billion_litres'][-1]:.1f}B litres")
+        peak = np.nanmax(df['diesel_billion_litres'])
+        peak_year = df['min_year'] + int(np.nanargmax(df['diesel_billion_litres']))
         print(f"   Peak: {peak:.1f}B litres in {peak_year}")
     else:
         print("   NOT AVAILABLE")
@@ -440,9 +505,9 @@ def summary(data: dict):
     print("\n4. VAN SALES DATA")
     if 'van_sales' in data:
         df = data['van_sales']
-        print(f"   Years: {df.index.min()} - {df.index.max()}")
-        latest = df.index.max()
-        print(f"   Latest ({latest}): {df.loc[latest, 'diesel_lcv']:,.0f} diesel LCVs ({df.loc[latest, 'diesel_share']:.1f}% share)")
+        print(f"   Years: {df['min_year']} - {df['max_year']}")
+        latest = df['max_year']
+        print(f"   Latest ({latest}): {df['diesel_lcv'][-1]:,.0f} diesel LCVs ({df['diesel_share'][-1]:.1f}% share)")
     else:
         print("   NOT AVAILABLE")
 